@@ -0,0 +1,94 @@
+# backend/cache.py
+
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+
+
+def query_key(query: str) -> str:
+    """
+    Returns a stable cache key for a user query.
+    The query is normalized (trimmed and lower-cased) before hashing so that
+    trivially different spellings of the same question share one entry.
+    """
+    return hashlib.sha256(query.strip().lower().encode()).hexdigest()
+
+
+class LRUCache:
+    """
+    A small process-wide LRU cache backed by an OrderedDict.
+    """
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        """Returns the cached value for `key`, or None on a miss."""
+        if key not in self._entries:
+            return None
+        self._entries.move_to_end(key)
+        return self._entries[key]
+
+    def put(self, key, value):
+        """Stores `value` under `key`, evicting the least recently used entry if full."""
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+
+class SemanticCache:
+    """
+    Caches values by embedding similarity so that paraphrased questions can
+    reuse an earlier answer. Embeddings are L2-normalized float32 rows of one
+    contiguous matrix, so a lookup is a single BLAS matrix-vector product.
+    Once `maxsize` entries are stored, new entries overwrite the oldest ones.
+    """
+
+    def __init__(self, threshold: float = 0.92, maxsize: int = 1024, initial_capacity: int = 64):
+        self.threshold = threshold
+        self.maxsize = maxsize
+        self._initial_capacity = min(initial_capacity, maxsize)
+        self._embeddings = None  # Allocated on first insert, once the dimension is known
+        self._values = []
+        self._oldest = 0  # Row overwritten by the next insert once the cache is full
+
+    @staticmethod
+    def normalize(embedding) -> np.ndarray:
+        """Converts an embedding to a unit-length float32 vector."""
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(self, vector: np.ndarray):
+        """Returns the value of the most similar cached entry above the threshold, or None."""
+        if not self._values:
+            return None
+        similarities = self._embeddings[:len(self._values)] @ vector
+        best = int(np.argmax(similarities))
+        if similarities[best] >= self.threshold:
+            return self._values[best]
+        return None
+
+    def add(self, vector: np.ndarray, value):
+        """
+        Stores `value` under a normalized embedding. The matrix grows geometrically
+        up to `maxsize` rows; after that the oldest row is overwritten in place.
+        """
+        count = len(self._values)
+        if count == self.maxsize:
+            row = self._oldest
+            self._oldest = (row + 1) % self.maxsize
+            self._embeddings[row] = vector
+            self._values[row] = value
+            return
+        if self._embeddings is None:
+            self._embeddings = np.empty((self._initial_capacity, vector.shape[0]), dtype=np.float32)
+        elif count == self._embeddings.shape[0]:
+            grown = np.empty((min(count * 2, self.maxsize), self._embeddings.shape[1]), dtype=np.float32)
+            grown[:count] = self._embeddings
+            self._embeddings = grown
+        self._embeddings[count] = vector
+        self._values.append(value)
@@ -1,7 +1,9 @@
 import os
+import time
+import threading
 from datetime import timedelta
 from couchbase.cluster import Cluster
-from couchbase.options import ClusterOptions
+from couchbase.options import ClusterOptions, QueryOptions
 from couchbase.auth import PasswordAuthenticator
 from couchbase.exceptions import CouchbaseException
 
@@ -10,31 +12,88 @@ CB_HOST = os.getenv("CB_HOST")
 CB_USERNAME = os.getenv("CB_USERNAME")
 CB_PASSWORD = os.getenv("CB_PASSWORD")
 CB_USE_TLS = os.getenv("CB_USE_TLS", "false").lower() == "true"
+CB_CONFIG_PROFILE = os.getenv("CB_CONFIG_PROFILE")  # e.g. "wan_development" for high-latency links
+# N1QL goes over the query service's HTTP connections; by default keep one per concurrent query
+CB_MAX_HTTP_CONNECTIONS = int(os.getenv("CB_MAX_HTTP_CONNECTIONS", os.getenv("DB_CONCURRENCY", 8)))
 BUCKET_NAME = "sales_poc"
 
 
 # --- Database Connection ---
-try:
+# The cluster is shared by all queries. After a failed connection attempt, callers
+# fail fast with a ConnectionError for CB_RECONNECT_BACKOFF seconds instead of each
+# building a new Cluster and blocking on wait_until_ready.
+CB_RECONNECT_BACKOFF = float(os.getenv("CB_RECONNECT_BACKOFF", 10))
+_cluster = None
+_last_failed_attempt = None
+_cluster_lock = threading.Lock()
+
+def _connect():
+    """
+    Builds a Cluster and waits until it is ready.
+    The half-built cluster is closed if it does not become ready in time.
+    """
     auth = PasswordAuthenticator(CB_USERNAME, CB_PASSWORD)
+    options = ClusterOptions(auth, max_http_connections=CB_MAX_HTTP_CONNECTIONS)
+    if CB_CONFIG_PROFILE:
+        options.apply_profile(CB_CONFIG_PROFILE)
 
     # Determine connection string based on TLS setting
     connection_string = f"couchbases://{CB_HOST}" if CB_USE_TLS else f"couchbase://{CB_HOST}"
     # For Capella, the SDK automatically handles TLS config with the 'couchbases' scheme.
 
-    cluster = Cluster(connection_string, ClusterOptions(auth))
+    cluster = Cluster(connection_string, options)
     timeout_seconds = int(os.getenv("CB_CONNECT_TIMEOUT", 30))
-    cluster.wait_until_ready(timeout=timedelta(seconds=timeout_seconds))
-
-    bucket = cluster.bucket(BUCKET_NAME)
+    try:
+        cluster.wait_until_ready(timeout=timedelta(seconds=timeout_seconds))
+    except Exception:
+        cluster.close()
+        raise
     print("Database connection successful.")
-except CouchbaseException as e:
-    print(f"Error connecting to Couchbase: {e}")
-    # In a real app, you might want to exit or have a retry mechanism
-    cluster = None
-    bucket = None
+    return cluster
+
+def get_cluster():
+    """
+    Returns the process-wide Couchbase cluster, connecting on first use.
+    Only one thread connects at a time; other callers, and all callers within
+    CB_RECONNECT_BACKOFF seconds of a failed attempt, get a ConnectionError.
+    """
+    global _cluster, _last_failed_attempt
+    if _cluster is not None:
+        return _cluster
+    if not _cluster_lock.acquire(blocking=False):
+        raise ConnectionError("Couchbase cluster is still connecting.")
+    try:
+        if _cluster is not None:
+            return _cluster
+        if _last_failed_attempt is not None:
+            retry_in = _last_failed_attempt + CB_RECONNECT_BACKOFF - time.monotonic()
+            if retry_in > 0:
+                raise ConnectionError(f"Couchbase cluster is not connected. Retrying in {retry_in:.1f}s.")
+        try:
+            _cluster = _connect()
+        except Exception:
+            _last_failed_attempt = time.monotonic()
+            raise
+        return _cluster
+    finally:
+        _cluster_lock.release()
 
 # --- Database Functions ---
 
+def query_error_message(error: Exception) -> str:
+    """
+    Returns a stable description of why a N1QL query failed.
+    For Couchbase errors this is the first error code and message reported by
+    the query service, without the per-request context (client context id,
+    dispatch address, raw HTTP body) that makes every occurrence look different.
+    """
+    context = getattr(error, "context", None)
+    code = getattr(context, "first_error_code", None)
+    message = getattr(context, "first_error_message", None)
+    if isinstance(error, CouchbaseException) and message:
+        return f"{code}: {message}"
+    return str(error)
+
 def execute_n1ql_query(query: str):
     """
     Executes a N1QL query against the Couchbase cluster.
@@ -45,13 +104,16 @@ def execute_n1ql_query(query: str):
     Returns:
         A list of query results, or raises an exception on failure.
     """
-    if not cluster:
-        raise ConnectionError("Couchbase cluster is not connected.")
-    
+    try:
+        cluster = get_cluster()
+    except CouchbaseException as e:
+        raise ConnectionError(f"Couchbase cluster is not connected: {e}")
+
     try:
         print(f"Executing N1QL Query: {query}")
-        result = cluster.query(query)
-        return [row for row in result.rows()]
+        # adhoc=False prepares the statement, so repeated query text reuses the cached plan
+        result = cluster.query(query, QueryOptions(adhoc=False))
+        return list(result.rows())
     except CouchbaseException as e:
         print(f"N1QL query failed: {e}")
         # Re-raise the exception to be handled by the API endpoint
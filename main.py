@@ -1,17 +1,20 @@
 import os
-import json
+import orjson
+import asyncio
+import concurrent.futures
 from dotenv import load_dotenv
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from contextlib import asynccontextmanager
-from langchain.prompts import PromptTemplate
 
 # Load environment variables from .env file
 load_dotenv()
 
 # Import your project modules
 # It's important to load env vars before these imports
+import cache
 import database
 import rag_chain
 
@@ -23,18 +26,30 @@ if __name__ == "__main__":
 # --- App Lifecycle (Startup & Shutdown) ---
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    global db_executor
     # This code runs on startup
     print("--- Server is starting up ---")
-    if database.cluster is None:
+    try:
+        database.get_cluster()
+    except Exception as e:
+        print(f"Error connecting to Couchbase: {e}")
         print("FATAL: Database connection failed. The server may not operate correctly.")
-    if rag_chain.llm is None or rag_chain.retriever is None:
-        print("FATAL: RAG chain components failed to initialize. The server may not operate correctly.")
+    if rag_chain.llm is None or not rag_chain.GOOGLE_API_KEY:
+        print("FATAL: RAG chain components failed to initialize. The server cannot generate reports.")
+        raise RuntimeError("RAG chain dependencies (llm or GOOGLE_API_KEY) are not initialized.")
+    rag_chain.open_http_client()
+    db_executor = concurrent.futures.ThreadPoolExecutor(max_workers=DB_CONCURRENCY, thread_name_prefix="n1ql")
+    # Load the embeddings model in the background so startup does not wait for it
+    embeddings_warmup = asyncio.create_task(asyncio.to_thread(rag_chain.get_embeddings))
     print("--- Startup complete ---")
     
     yield # The application runs while the server is alive
     
     # This code runs on shutdown
     print("--- Server is shutting down ---")
+    embeddings_warmup.cancel()
+    db_executor.shutdown(wait=False, cancel_futures=True)
+    await rag_chain.close_http_client()
 
 
 # --- FastAPI App Initialization ---
@@ -65,73 +80,353 @@ class QueryResponse(BaseModel):
     result: str
 
 
-# --- API Endpoint ---
-@app.post("/generate-report", response_model=QueryResponse)
-async def generate_report(request: QueryRequest):
+# --- Response Cache ---
+# Identical questions skip the LLM and database round-trips entirely.
+response_cache = cache.LRUCache(maxsize=int(os.getenv("RESPONSE_CACHE_SIZE", 1024)))
+# Paraphrased questions are matched by embedding similarity.
+semantic_cache = cache.SemanticCache(
+    threshold=float(os.getenv("SEMANTIC_CACHE_THRESHOLD", 0.92)),
+    maxsize=int(os.getenv("SEMANTIC_CACHE_SIZE", 1024))
+)
+# Embedding the query is a remote call on every exact-cache miss, so it is capped in
+# time and concurrency; when it cannot run right away the semantic cache is skipped.
+EMBED_TIMEOUT_SECONDS = float(os.getenv("EMBED_TIMEOUT_SECONDS", 1))
+embed_semaphore = asyncio.Semaphore(int(os.getenv("EMBED_CONCURRENCY", 8)))
+# Last N1QL that executed successfully for each query. It outlives response cache
+# entries, so on a repeat it can be executed speculatively while the LLM generates.
+query_shape_cache = cache.LRUCache(maxsize=int(os.getenv("QUERY_SHAPE_CACHE_SIZE", 4096)))
+# Self-corrections per (question, failed query, error), so a repeated failure reuses the earlier fix.
+fix_cache = cache.LRUCache(maxsize=512)
+
+# --- Downstream Concurrency Limits ---
+# Caps in-flight LLM calls and N1QL queries across all requests. A request that
+# cannot get a slot within SLOT_TIMEOUT_SECONDS is rejected with HTTP 429.
+llm_semaphore = asyncio.Semaphore(int(os.getenv("LLM_CONCURRENCY", 8)))
+DB_CONCURRENCY = int(os.getenv("DB_CONCURRENCY", 8))
+db_semaphore = asyncio.Semaphore(DB_CONCURRENCY)
+# N1QL queries run on their own pool, sized to the limit, so an admitted query
+# never waits behind other work in the default executor. Created by the lifespan.
+db_executor = None
+SLOT_TIMEOUT_SECONDS = float(os.getenv("SLOT_TIMEOUT_SECONDS", 5))
+
+# Results larger than this are summarized from a preview plus aggregates, not in full.
+SUMMARY_PREVIEW_ROWS = int(os.getenv("SUMMARY_PREVIEW_ROWS", 50))
+
+
+async def _wait_for_slot(semaphore: asyncio.Semaphore, name: str):
     """
-    The main endpoint to generate a report from a natural language query.
-    This endpoint will try up to 3 times to generate a valid, executable query.
+    Takes one slot of a downstream concurrency limit.
+    Raises an HTTP 429 with a Retry-After header if no slot frees up in time.
     """
-    user_query = request.query
-    print(f"\nReceived new query: {user_query}")
+    try:
+        await asyncio.wait_for(semaphore.acquire(), timeout=SLOT_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        print(f"No {name} capacity available, rejecting request.")
+        raise HTTPException(
+            status_code=429,
+            detail=f"The {name} is busy. Please retry shortly.",
+            headers={"Retry-After": str(max(1, round(SLOT_TIMEOUT_SECONDS)))}
+        )
+
+
+@asynccontextmanager
+async def _acquire_slot(semaphore: asyncio.Semaphore, name: str):
+    """Holds one slot of a downstream concurrency limit for the duration of the block."""
+    await _wait_for_slot(semaphore, name)
+    try:
+        yield
+    finally:
+        semaphore.release()
+
+
+def _release_db_slot(loop: asyncio.AbstractEventLoop):
+    """Returns a database slot from the worker thread that finished with it."""
+    try:
+        loop.call_soon_threadsafe(db_semaphore.release)
+    except RuntimeError:
+        pass  # The event loop is already closed, so nobody is waiting for the slot
+
+
+async def _execute_query(n1ql: str):
+    """
+    Executes a N1QL query in a worker thread, within the database concurrency limit.
+    The slot is released when the worker thread finishes, not when the caller stops
+    waiting: cancelling a draft does not stop a query that is already running.
+    """
+    await _wait_for_slot(db_semaphore, "database")
+    loop = asyncio.get_running_loop()
+    try:
+        future = db_executor.submit(database.execute_n1ql_query, n1ql)
+    except BaseException:
+        db_semaphore.release()
+        raise
+    future.add_done_callback(lambda _: _release_db_slot(loop))
+    return await asyncio.wrap_future(future)
+
 
-    max_retries = 3
-    last_error = None
-    query_result = None
+async def _embed_query(user_query: str):
+    """
+    Embeds the user query for the semantic cache.
+    Returns None if embeddings are unavailable, too many are in flight, or the call
+    takes longer than EMBED_TIMEOUT_SECONDS, which skips the semantic cache.
+    """
+    if embed_semaphore.locked():
+        print("Too many queries being embedded, skipping the semantic cache.")
+        return None
+
+    async def _embed():
+        embeddings = await asyncio.to_thread(rag_chain.get_embeddings)
+        if embeddings is None:
+            return None
+        return await embeddings.aembed_query(user_query)
+
+    try:
+        async with embed_semaphore:
+            embedding = await asyncio.wait_for(_embed(), timeout=EMBED_TIMEOUT_SECONDS)
+        return None if embedding is None else cache.SemanticCache.normalize(embedding)
+    except asyncio.TimeoutError:
+        print("Embedding the query timed out, skipping the semantic cache.")
+        return None
+    except Exception as e:
+        print(f"Could not embed query for the semantic cache: {e}")
+        return None
+
+
+async def _fix_n1ql(question: str, failed_query: str, error_message: str):
+    """
+    Asks the LLM to correct a failed N1QL query.
+    Memoized in `fix_cache`, so a failure that has been seen before reuses the
+    earlier fix instead of making another LLM call.
+    """
+    key = (question, failed_query, error_message)
+    fixed_query = fix_cache.get(key)
+    if fixed_query is None:
+        async with _acquire_slot(llm_semaphore, "LLM"):
+            fixed_query = await rag_chain.fix_n1ql(question, failed_query, error_message)
+        fix_cache.put(key, fixed_query)
+    return fixed_query
+
+
+async def _run_draft(user_query: str, draft: int, speculative=None):
+    """
+    Generates one N1QL draft and executes it.
+    If the draft matches the speculative (n1ql, task) pair, the result of the
+    already in-flight query is awaited instead of executing it again.
+
+    Returns:
+        A (generated_n1ql, query_result, error) tuple. `error` is None on success.
+        Raises an HTTPException if a downstream slot could not be acquired, an
+        LLMError if the draft could not be generated, and a ConnectionError if the
+        database is unreachable.
+    """
     generated_n1ql = ""
+    try:
+        print(f"Generating N1QL draft {draft + 1}...")
+        async with _acquire_slot(llm_semaphore, "LLM"):
+            generated_n1ql = await rag_chain.generate_n1ql(user_query)
+
+        if not generated_n1ql or not isinstance(generated_n1ql, str):
+            raise rag_chain.LLMError("LLM failed to generate a valid N1QL string.")
+
+        if speculative is not None and generated_n1ql.strip() == speculative[0]:
+            print(f"Draft {draft + 1} matches the speculative query, reusing its result.")
+            # Shield the shared task so cancelling this draft does not cancel it for others
+            query_result = await asyncio.shield(speculative[1])
+        else:
+            query_result = await _execute_query(generated_n1ql)
+        return generated_n1ql, query_result, None
+    except (HTTPException, rag_chain.LLMError, ConnectionError):
+        raise
+    except Exception as e:
+        print(f"Draft {draft + 1} failed: {e}")
+        return generated_n1ql, None, database.query_error_message(e)
+
+
+def _numeric_stats(query_result: list) -> dict:
+    """Computes count/sum/avg/min/max for every top-level numeric field of the result rows."""
+    columns = {}
+    for row in query_result:
+        if not isinstance(row, dict):
+            continue
+        for field, value in row.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                columns.setdefault(field, []).append(value)
+    return {
+        field: {
+            "count": len(values),
+            "sum": sum(values),
+            "avg": sum(values) / len(values),
+            "min": min(values),
+            "max": max(values),
+        }
+        for field, values in columns.items()
+    }
+
+
+def _summary_query_result(query_result: list, result_str: str) -> str:
+    """
+    Returns the query result to pass to the summary prompt.
+    Small results are passed as-is; larger ones are capped to the first
+    SUMMARY_PREVIEW_ROWS rows plus the total row count and numeric aggregates,
+    which keeps the prompt size bounded.
+    """
+    if len(query_result) <= SUMMARY_PREVIEW_ROWS:
+        return result_str
+    return orjson.dumps({
+        "total_rows": len(query_result),
+        "stats": _numeric_stats(query_result),
+        "preview": query_result[:SUMMARY_PREVIEW_ROWS],
+    }, option=orjson.OPT_INDENT_2).decode()
+
+
+def _ndjson_line(payload: dict) -> bytes:
+    """Serializes one line of a newline-delimited JSON stream."""
+    return orjson.dumps(payload, option=orjson.OPT_APPEND_NEWLINE)
+
 
-    # --- Chain for fixing a failed query ---
-    fix_n1ql_template = """
-    The user asked the following question: "{question}"
-    I generated this N1QL query:
-    ---
-    {failed_query}
-    ---
-    But it failed with this error:
-    ---
-    {error_message}
-    ---
-    Please correct the N1QL query to fix the error.
-    You must follow these rules:
-    1. Only return the corrected N1QL query.
-    2. Do not add any explanation, introductory text, or markdown formatting.
-    3. Ensure all date functions like NOW_STR() are used correctly for Couchbase N1QL.
-    """
-    FIX_N1QL_PROMPT = PromptTemplate.from_template(fix_n1ql_template)
-    fix_n1ql_chain = FIX_N1QL_PROMPT | rag_chain.llm | rag_chain.StrOutputParser()
-
-    for attempt in range(max_retries):
-        print(f"\n--- Attempt {attempt + 1} of {max_retries} ---")
+async def _lookup_cached_report(user_query: str, cache_key: str):
+    """
+    Looks the query up in the exact-match cache, then in the semantic cache.
+
+    Returns:
+        A (cached_response, query_vector) tuple. `cached_response` is None on a miss;
+        `query_vector` is the normalized query embedding, if one was computed.
+    """
+    cached_response = response_cache.get(cache_key)
+    if cached_response is not None:
+        print("Returning cached report.")
+        return cached_response, None
+
+    query_vector = await _embed_query(user_query)
+    if query_vector is not None:
+        cached_response = semantic_cache.lookup(query_vector)
+        if cached_response is not None:
+            print("Returning cached report for a similar query.")
+    return cached_response, query_vector
+
+
+def _cache_report(cache_key: str, query_vector, response: QueryResponse):
+    """Stores a successfully generated report in the response caches."""
+    response_cache.put(cache_key, response)
+    if query_vector is not None:
+        semantic_cache.add(query_vector, response)
+
+
+def _database_unavailable(error: ConnectionError) -> HTTPException:
+    """Builds the HTTP 503 returned when the database cannot be reached."""
+    print(f"Database unavailable: {error}")
+    return HTTPException(
+        status_code=503,
+        detail="The database is unavailable. Please retry shortly.",
+        headers={"Retry-After": str(max(1, round(database.CB_RECONNECT_BACKOFF)))}
+    )
+
+
+async def _generate_query_result(user_query: str, cache_key: str):
+    """
+    Generates a N1QL query for the user's question and executes it.
+    Several drafts are generated and executed concurrently; if none of them
+    succeeds, falls back to asking the LLM to self-correct.
+
+    Returns:
+        A (generated_n1ql, query_result) tuple, or raises an HTTPException on failure.
+    """
+    num_drafts = 3
+    max_fixes = 2
+
+    # Speculatively execute the last successful query for this question while the LLM runs
+    speculative = None
+    previous_n1ql = query_shape_cache.get(cache_key)
+    if previous_n1ql is not None:
+        print("Speculatively executing the previous N1QL query for this question...")
+        speculative_task = asyncio.create_task(_execute_query(previous_n1ql))
+        # Mark a failed speculative result as retrieved even if no draft ends up awaiting it
+        speculative_task.add_done_callback(lambda task: task.cancelled() or task.exception())
+        speculative = (previous_n1ql, speculative_task)
+
+    # Step 1 & 2: Generate several drafts concurrently and keep the first one that executes
+    print(f"\n--- Generating {num_drafts} N1QL drafts concurrently ---")
+    draft_tasks = [
+        asyncio.create_task(_run_draft(user_query, draft, speculative))
+        for draft in range(num_drafts)
+    ]
+    generated_n1ql, query_result, last_error = "", None, None
+    overloaded, llm_error, db_error = None, None, None
+    try:
+        for next_draft in asyncio.as_completed(draft_tasks):
+            try:
+                draft_n1ql, draft_result, draft_error = await next_draft
+            except HTTPException as e:
+                # A draft that could not get a downstream slot says nothing about the query
+                overloaded = e
+                continue
+            except rag_chain.LLMError as e:
+                # Neither does an LLM failure, and there is no query to self-correct
+                print(f"Draft failed: {e}")
+                llm_error = e
+                continue
+            except ConnectionError as e:
+                # Nor does an unreachable database, which no rewrite of the query can fix
+                db_error = e
+                continue
+            if draft_error is None:
+                generated_n1ql, query_result = draft_n1ql, draft_result
+                print("Query executed successfully!")
+                break
+            if last_error is None:
+                # Keep the first failure as the starting point for self-correction
+                generated_n1ql, last_error = draft_n1ql, draft_error
+    finally:
+        for task in draft_tasks:
+            task.cancel()
+        if speculative is not None:
+            speculative[1].cancel()
+
+    if query_result is None and last_error is None:
+        # No draft got far enough to fail, so there is nothing to self-correct
+        if db_error is not None:
+            raise _database_unavailable(db_error)
+        if overloaded is not None:
+            raise overloaded
+        raise HTTPException(
+            status_code=500,
+            detail=f"Unable to get data at this time. The AI agent could not generate a query: {llm_error}"
+        )
+
+    # Fallback: every draft failed, so ask the LLM to correct the first failed query
+    for attempt in range(max_fixes):
+        if query_result is not None:
+            break
+        print(f"\n--- Self-correction attempt {attempt + 1} of {max_fixes} ---")
         try:
-            # Step 1: Generate N1QL query
-            if attempt == 0:
-                # First attempt: use the standard RAG chain
-                print("Generating initial N1QL query...")
-                n1ql_generation_chain = rag_chain.get_rag_chain()
-                generated_n1ql = n1ql_generation_chain.invoke(user_query)
-            else:
-                # Subsequent attempts: use the self-correction chain
-                print("Attempting to self-correct previous query...")
-                generated_n1ql = fix_n1ql_chain.invoke({
-                    "question": user_query,
-                    "failed_query": generated_n1ql, # Use the previously failed query
-                    "error_message": last_error
-                })
+            failed_query = generated_n1ql # Use the previously failed query
+            generated_n1ql = await _fix_n1ql(user_query, failed_query, last_error)
 
             if not generated_n1ql or not isinstance(generated_n1ql, str):
-                last_error = "LLM failed to generate a valid N1QL string."
-                continue # Go to the next attempt
+                raise rag_chain.LLMError("LLM failed to generate a valid N1QL string.")
 
-            # Step 2: Execute the generated N1QL query
-            query_result = database.execute_n1ql_query(generated_n1ql)
+            if generated_n1ql.strip() == failed_query.strip():
+                # Re-executing a query that is known to fail would only fail again
+                print("Self-correction returned the same failing query. Giving up.")
+                break
+
+            query_result = await _execute_query(generated_n1ql)
             print("Query executed successfully!")
             break  # If successful, exit the loop
 
+        except HTTPException:
+            raise
+        except rag_chain.LLMError as e:
+            # Without a corrected query there is nothing left to try
+            print(f"Self-correction attempt {attempt + 1} failed: {e}")
+            break
+        except ConnectionError as e:
+            raise _database_unavailable(e)
         except Exception as e:
-            last_error = str(e)
-            print(f"Attempt {attempt + 1} failed: {last_error}")
+            last_error = database.query_error_message(e)
+            print(f"Self-correction attempt {attempt + 1} failed: {last_error}")
             # If this is the last attempt, the loop will end
-            if attempt == max_retries - 1:
+            if attempt == max_fixes - 1:
                 print("All retry attempts failed.")
 
     # After the loop, check if we have a successful result
@@ -140,25 +435,121 @@ async def generate_report(request: QueryRequest):
             status_code=500,
             detail="Unable to get data at this time. The AI agent could not generate a valid query after multiple attempts."
         )
+    query_shape_cache.put(cache_key, generated_n1ql.strip())
+
+    return generated_n1ql, query_result
+
+
+# --- API Endpoints ---
+@app.post("/generate-report", response_model=QueryResponse)
+async def generate_report(request: QueryRequest):
+    """
+    The main endpoint to generate a report from a natural language query.
+    """
+    user_query = request.query
+    print(f"\nReceived new query: {user_query}")
+
+    cache_key = cache.query_key(user_query)
+    cached_response, query_vector = await _lookup_cached_report(user_query, cache_key)
+    if cached_response is not None:
+        return cached_response
+
+    generated_n1ql, query_result = await _generate_query_result(user_query, cache_key)
 
     # If successful, proceed with summarization
     try:
-        result_str = json.dumps(query_result, indent=2)
+        result_str = orjson.dumps(query_result, option=orjson.OPT_INDENT_2).decode()
 
         # Step 3: Generate a human-readable summary
         summary_chain = rag_chain.get_summary_chain()
-        report = summary_chain.invoke({
-            "question": user_query,
-            "query_result": result_str
-        })
+        async with _acquire_slot(llm_semaphore, "LLM"):
+            report = await asyncio.to_thread(summary_chain.invoke, {
+                "question": user_query,
+                "query_result": _summary_query_result(query_result, result_str)
+            })
 
         print(f"Generated Report: {report}")
 
-        return QueryResponse(
+        response = QueryResponse(
             report=report,
             generated_n1ql=generated_n1ql,
             result=result_str
         )
+        _cache_report(cache_key, query_vector, response)
+        return response
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"An unexpected error occurred during summarization: {e}")
         raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/generate-report/stream")
+async def generate_report_stream(request: QueryRequest):
+    """
+    Same as /generate-report, but streams the summary while it is generated.
+    The response is newline-delimited JSON: a first line with `generated_n1ql` and
+    `result`, followed by one `{"delta": ...}` line per chunk of the report.
+    """
+    user_query = request.query
+    print(f"\nReceived new streaming query: {user_query}")
+
+    cache_key = cache.query_key(user_query)
+    cached_response, query_vector = await _lookup_cached_report(user_query, cache_key)
+    if cached_response is not None:
+        async def _stream_cached():
+            yield _ndjson_line({"generated_n1ql": cached_response.generated_n1ql, "result": cached_response.result})
+            yield _ndjson_line({"delta": cached_response.report})
+        return StreamingResponse(_stream_cached(), media_type="application/x-ndjson")
+
+    generated_n1ql, query_result = await _generate_query_result(user_query, cache_key)
+    result_str = orjson.dumps(query_result, option=orjson.OPT_INDENT_2).decode()
+    summary_chain = rag_chain.get_summary_chain()
+
+    # Take the LLM slot before any headers are sent, so saturation is still a 429
+    await _wait_for_slot(llm_semaphore, "LLM")
+    chunk_queue = asyncio.Queue()
+
+    async def _summarize():
+        # Runs independently of the client, so a slow reader does not hold the LLM slot
+        try:
+            async for chunk in summary_chain.astream({
+                "question": user_query,
+                "query_result": _summary_query_result(query_result, result_str)
+            }):
+                chunk_queue.put_nowait(chunk)
+            chunk_queue.put_nowait(None)
+        except Exception as e:
+            chunk_queue.put_nowait(e)
+
+    summary_task = asyncio.create_task(_summarize())
+    # A done callback also runs if the task is cancelled before it ever starts
+    summary_task.add_done_callback(lambda _: llm_semaphore.release())
+
+    async def _stream():
+        yield _ndjson_line({"generated_n1ql": generated_n1ql, "result": result_str})
+
+        # Step 3: Stream the human-readable summary as it is generated
+        chunks = []
+        try:
+            while (chunk := await chunk_queue.get()) is not None:
+                if isinstance(chunk, Exception):
+                    # Headers are already sent, so report the failure in-band
+                    print(f"An unexpected error occurred during summarization: {chunk}")
+                    yield _ndjson_line({"error": str(chunk)})
+                    return
+                chunks.append(chunk)
+                yield _ndjson_line({"delta": chunk})
+        finally:
+            # Stops the summary if the client disconnected mid-stream
+            summary_task.cancel()
+
+        report = "".join(chunks)
+        print(f"Generated Report: {report}")
+        _cache_report(cache_key, query_vector, QueryResponse(
+            report=report,
+            generated_n1ql=generated_n1ql,
+            result=result_str
+        ))
+
+    return StreamingResponse(_stream(), media_type="application/x-ndjson")
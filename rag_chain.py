@@ -1,36 +1,50 @@
 import os
+import random
+import asyncio
+import functools
+import httpx
 from langchain_google_genai import GoogleGenerativeAI, GoogleGenerativeAIEmbeddings
-from langchain_community.vectorstores import Chroma
 from langchain.prompts import PromptTemplate
-from langchain.schema.runnable import RunnablePassthrough
 from langchain.schema.output_parser import StrOutputParser
 
 from knowledge import schema_knowledge
 
 # --- Configuration ---
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
+LLM_MODEL = "gemini-2.5-flash-lite"
+GEMINI_API_URL = "https://generativelanguage.googleapis.com/v1beta"
 
-# --- LLM and Embeddings Initialization ---
+# --- LLM Initialization ---
 try:
-    llm = GoogleGenerativeAI(model="gemini-2.5-flash-lite", google_api_key=GOOGLE_API_KEY)
-    embeddings = GoogleGenerativeAIEmbeddings(model="models/text-embedding-004", google_api_key=GOOGLE_API_KEY)
-    print("LLM and Embeddings models initialized successfully.")
+    llm = GoogleGenerativeAI(model=LLM_MODEL, google_api_key=GOOGLE_API_KEY)
+    print("LLM initialized successfully.")
 except Exception as e:
     print(f"Error initializing Google AI models: {e}")
     llm = None
-    embeddings = None
 
-# --- Vector Store Setup ---
-try:
-    vector_store = Chroma.from_texts(
-        texts=schema_knowledge,
-        embedding=embeddings
-    )
-    retriever = vector_store.as_retriever(search_kwargs={"k": 2}) # Retrieve top 2 most relevant documents
-    print("Vector store created and retriever is ready.")
-except Exception as e:
-    print(f"Error creating vector store: {e}")
-    retriever = None
+# --- Embeddings Initialization ---
+# Only the semantic cache needs embeddings, so the model is created on first use
+# rather than at import time, keeping it off the server startup path.
+_embeddings = None
+
+def get_embeddings():
+    """
+    Returns the embeddings model, initializing it on first use.
+    Returns None if the model could not be initialized.
+    """
+    global _embeddings
+    if _embeddings is None:
+        try:
+            _embeddings = GoogleGenerativeAIEmbeddings(model="models/text-embedding-004", google_api_key=GOOGLE_API_KEY)
+            print("Embeddings model initialized successfully.")
+        except Exception as e:
+            print(f"Error initializing embeddings model: {e}")
+    return _embeddings
+
+# --- Schema Context ---
+# The schema knowledge base is small enough to send in full with every prompt,
+# so it is joined once here instead of being retrieved from a vector store.
+SCHEMA_CONTEXT = "\n\n".join(schema_knowledge)
 
 # --- Prompt Templates ---
 
@@ -56,11 +70,6 @@ You must follow these rules:
 
 **N1QL Query:**
 """
-N1QL_PROMPT = PromptTemplate(
-    input_variables=["context", "question"],
-    template=n1ql_prompt_template,
-)
-
 # 2. Result Summarization Prompt
 summary_prompt_template = """
 You are an AI assistant for a business intelligence dashboard.
@@ -73,6 +82,7 @@ The data from the database is:
 Based on this data, provide a clear, natural language summary.
 After the summary, if the data is not empty, display the full results in a Markdown table.
 If the data is empty, just state that you couldn't find an answer.
+If the data only contains a preview of a larger result (it has `total_rows`, `stats` and `preview` fields), base the summary on `total_rows` and `stats`, show only the preview rows in the table, and say that only the first rows are shown.
 Do not mention N1QL or the database. Just present the answer to the user.
 
 **Summary:**
@@ -82,28 +92,130 @@ SUMMARY_PROMPT = PromptTemplate(
     template=summary_prompt_template,
 )
 
+# 3. N1QL Self-Correction Prompt
+fix_n1ql_prompt_template = """
+The user asked the following question: "{question}"
+I generated this N1QL query:
+---
+{failed_query}
+---
+But it failed with this error:
+---
+{error_message}
+---
+Please correct the N1QL query to fix the error.
+You must follow these rules:
+1. Only return the corrected N1QL query.
+2. Do not add any explanation, introductory text, or markdown formatting.
+3. Ensure all date functions like NOW_STR() are used correctly for Couchbase N1QL.
+"""
 
-# --- LangChain Chains ---
 
-def get_rag_chain():
+# --- Direct LLM Calls ---
+# The short N1QL generation and self-correction prompts are sent straight to the
+# Gemini REST API over a shared HTTP/2 client, skipping LangChain's per-call overhead.
+# The client is opened and closed by the app lifespan, so each run gets a fresh one.
+http_client = None
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", 3))
+LLM_RETRY_BASE_DELAY = float(os.getenv("LLM_RETRY_BASE_DELAY", 0.5))
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+def open_http_client():
+    """Creates the shared HTTP/2 client used for direct LLM calls."""
+    global http_client
+    http_client = httpx.AsyncClient(http2=True, timeout=60, base_url=GEMINI_API_URL)
+
+async def close_http_client():
+    """Closes the shared HTTP/2 client, if it is open."""
+    global http_client
+    if http_client is not None:
+        await http_client.aclose()
+        http_client = None
+
+
+class LLMError(Exception):
+    """
+    Raised when the LLM could not be reached or returned no usable text.
+    This says nothing about the N1QL query, so it must not be self-corrected.
+    """
+
+
+async def _post_with_retries(path: str, payload: dict) -> httpx.Response:
+    """
+    POSTs to the Gemini API, retrying rate limits, server errors and transport
+    failures with exponential backoff and jitter.
     """
-    Builds and returns the primary RAG chain for generating N1QL.
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        try:
+            response = await http_client.post(path, headers={"x-goog-api-key": GOOGLE_API_KEY}, json=payload)
+            if response.status_code not in RETRYABLE_STATUS_CODES:
+                response.raise_for_status()
+                return response
+            error = f"LLM request failed with HTTP {response.status_code}: {response.text}"
+        except httpx.HTTPStatusError as e:
+            raise LLMError(f"LLM request failed with HTTP {e.response.status_code}: {e.response.text}") from e
+        except httpx.TransportError as e:
+            error = f"LLM request failed: {e!r}"
+        except httpx.RequestError as e:
+            # e.g. an undecodable response body; retrying would not help
+            raise LLMError(f"LLM request failed: {e!r}") from e
+        if attempt < LLM_MAX_RETRIES:
+            delay = LLM_RETRY_BASE_DELAY * 2 ** attempt
+            print(f"{error}. Retrying in {delay:.1f}s...")
+            await asyncio.sleep(delay + random.uniform(0, delay))
+    raise LLMError(f"{error} (after {LLM_MAX_RETRIES + 1} attempts)")
+
+
+async def call_llm(prompt: str) -> str:
     """
-    if not retriever or not llm:
-        raise ConnectionError("RAG chain dependencies (retriever or llm) are not initialized.")
-
-    return (
-        {"context": retriever, "question": RunnablePassthrough()}
-        | N1QL_PROMPT
-        | llm
-        | StrOutputParser()
+    Sends a single prompt to the LLM and returns the generated text.
+    Raises an LLMError if the request fails or the response has no text,
+    e.g. because the prompt was blocked or generation stopped for safety.
+    """
+    response = await _post_with_retries(
+        f"/models/{LLM_MODEL}:generateContent",
+        {"contents": [{"role": "user", "parts": [{"text": prompt}]}]},
     )
+    try:
+        body = response.json()
+        candidates = body.get("candidates") or []
+        if not candidates:
+            reason = body.get("promptFeedback", {}).get("blockReason", "no candidates returned")
+            raise LLMError(f"LLM returned no response: {reason}")
+        candidate = candidates[0]
+        text = "".join(part.get("text", "") for part in candidate.get("content", {}).get("parts", []))
+    except (ValueError, TypeError, AttributeError, KeyError, IndexError) as e:
+        # Not the JSON shape the API documents, e.g. an HTML error page from a proxy
+        raise LLMError(f"LLM returned an unreadable response: {response.text[:200]!r}") from e
+    if not text:
+        raise LLMError(f"LLM returned no text (finish reason: {candidate.get('finishReason', 'unknown')})")
+    return text
+
+async def generate_n1ql(question: str) -> str:
+    """
+    Generates a N1QL query for the user's question.
+    """
+    return await call_llm(n1ql_prompt_template.format(context=SCHEMA_CONTEXT, question=question))
+
+async def fix_n1ql(question: str, failed_query: str, error_message: str) -> str:
+    """
+    Asks the LLM to correct a N1QL query that failed to execute.
+    """
+    return await call_llm(fix_n1ql_prompt_template.format(
+        question=question,
+        failed_query=failed_query,
+        error_message=error_message
+    ))
+
+
+# --- LangChain Chains ---
+# The summary is long enough that chain overhead is negligible, and it is streamed.
+# Dependencies are checked once at server startup, not on every call.
 
+@functools.cache
 def get_summary_chain():
     """
-    Builds and returns the chain for summarizing query results.
+    Returns the chain for summarizing query results, built once and shared by all requests.
     """
-    if not llm:
-        raise ConnectionError("Summarization chain dependency (llm) is not initialized.")
-        
     return SUMMARY_PROMPT | llm | StrOutputParser()
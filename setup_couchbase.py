@@ -1,7 +1,7 @@
 import time
 import os
-import random
 from datetime import datetime, timedelta
+import numpy as np
 from dotenv import load_dotenv
 from couchbase.cluster import Cluster
 from couchbase.options import ClusterOptions
@@ -145,41 +145,61 @@ def _insert_sample_data(customer_collection, sales_collection):
     loyalty_levels = ["Gold", "Silver", "Bronze", "Platinum"]
     products = ["Quantum Widget", "Hyper-Sprocket", "Nano-Gear", "Omega Drive", "Pico-Relay", "Zeta Capacitor", "Epsilon Diode"]
 
+    # Each field is sampled for all documents at once, then zipped into documents
+    rng = np.random.default_rng()
+
     # --- Generate 50 Customers ---
-    customer_ids = []
     print("Generating 50 customers...")
-    for i in range(50):
-        doc_id = f"cust::{i+1:03d}"
-        customer_ids.append(doc_id)
-        customer = {
-            "name": f"{random.choice(first_names)} {random.choice(last_names)}",
-            "city": random.choice(cities),
-            "loyalty_level": random.choice(loyalty_levels)
+    num_customers = 50
+    customers = {
+        f"cust::{i+1:03d}": {
+            "name": f"{first} {last}",
+            "city": city,
+            "loyalty_level": loyalty_level
         }
-        try:
-            customer_collection.upsert(doc_id, customer)
-        except Exception as e:
-            print(f"Error inserting customer {doc_id}: {e}")
+        for i, (first, last, city, loyalty_level) in enumerate(zip(
+            rng.choice(first_names, num_customers).tolist(),
+            rng.choice(last_names, num_customers).tolist(),
+            rng.choice(cities, num_customers).tolist(),
+            rng.choice(loyalty_levels, num_customers).tolist()
+        ))
+    }
+    _upsert_batch(customer_collection, customers, "customer")
     print("Customer generation complete.")
 
     # --- Generate 200 Sales ---
     print("\nGenerating 200 sales records...")
+    num_sales = 200
     start_date = datetime.now() - timedelta(days=365)
-    for i in range(200):
-        doc_id = f"sale::{i+1:03d}"
-        random_days = random.randint(0, 365)
-        sale = {
-            "product_name": random.choice(products),
-            "sale_amount": random.randint(500, 15000),
-            "sale_date": (start_date + timedelta(days=random_days)).strftime("%Y-%m-%d"),
-            "customer_id": random.choice(customer_ids) # Link to a random, existing customer
+    sales = {
+        f"sale::{i+1:03d}": {
+            "product_name": product_name,
+            "sale_amount": sale_amount,
+            "sale_date": (start_date + timedelta(days=day_offset)).strftime("%Y-%m-%d"),
+            "customer_id": customer_id # Link to a random, existing customer
         }
-        try:
-            sales_collection.upsert(doc_id, sale)
-        except Exception as e:
-            print(f"Error inserting sale {doc_id}: {e}")
+        for i, (product_name, sale_amount, day_offset, customer_id) in enumerate(zip(
+            rng.choice(products, num_sales).tolist(),
+            rng.integers(500, 15001, num_sales).tolist(),
+            rng.integers(0, 366, num_sales).tolist(),
+            rng.choice(list(customers), num_sales).tolist()
+        ))
+    }
+    _upsert_batch(sales_collection, sales, "sale")
     print("Sales generation complete.")
 
 
+def _upsert_batch(collection, documents, label):
+    """Helper function to upsert a batch of documents in a single multi-operation."""
+    try:
+        result = collection.upsert_multi(documents)
+    except Exception as e:
+        print(f"Error inserting {label} documents: {e}")
+        return
+    if not result.all_ok:
+        for doc_id, error in result.exceptions.items():
+            print(f"Error inserting {label} {doc_id}: {error}")
+
+
 if __name__ == "__main__":
     setup_database()
\ No newline at end of file